@@ -2,30 +2,108 @@ from pathlib import Path
 from typing import Dict, List, Optional
 import threading
 from base.storage_engine import BaseStorageEngine
-from storage_io.segment_log import LogSegment, LogSegmentManager
+from storage_io.segment_log import LogSegment, LogSegmentManager, RolloverPolicy, SegmentHandleCache
 
 
 PATH = "."
 
 
-class Bitcask(BaseStorageEngine):
+class BitcaskSnapshot(BaseStorageEngine):
+    """
+    Read-only point-in-time view of a Bitcask engine, pinned to a sequence number.
+    The segments it references are kept on disk until the snapshot is released, even if the engine compacts them away.
+    """
     _data: List[Dict[str, int]]
+    _segments: List[LogSegment]
     _log_manager: LogSegmentManager
 
-    def __init__(self, path: str, max_segment_size: int = 1024 * 1024):
-        self._log_manager = LogSegmentManager(path, max_segment_size=max_segment_size)
+    def __init__(self, path: str, log_manager: LogSegmentManager, segments: List[LogSegment],
+                 index: List[Dict[str, int]], sequence: int):
         super().__init__(path)
-        self._data = self._log_manager.rebuild_index()
+        self._log_manager = log_manager
+        self._segments = segments
+        self._data = index
+        self.sequence = sequence
+        self._released = False
+        self._log_manager.acquire(self._segments)
 
     def get(self, key: str) -> str:
+        if self._released:
+            raise RuntimeError("Snapshot has been released")
         for i in range(len(self.data) - 1, -1, -1):
             if key in self.data[i]:
                 offset = self.data[i][key]
-                entry = self._log_manager.get_from_segment(i, offset)
+                entry = self._log_manager.read_segment(self._segments[i], offset)
                 return entry[key]
 
         raise ValueError(f"Key {key} not found")
 
+    def set(self, key: str, value: str) -> None:
+        raise RuntimeError("Snapshots are read-only")
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._log_manager.release(self._segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class Bitcask(BaseStorageEngine):
+    _data: List[Dict[str, int]]
+    _log_manager: LogSegmentManager
+    # Number of writes applied so far, starting from the records found on disk. Snapshots are pinned to the sequence
+    # number at the time they were taken
+    _sequence: int
+
+    def __init__(self, path: str, max_segment_size: Optional[int] = None,
+                 rollover_policy: Optional[RolloverPolicy] = None, handle_cache: Optional[SegmentHandleCache] = None):
+        """
+        :param max_segment_size: max size of the segments in bytes (1 MB by default). Can't be combined with
+            rollover_policy, which sets the size trigger together with the others.
+        """
+        self._log_manager = LogSegmentManager(path, max_segment_size=max_segment_size,
+                                              rollover_policy=rollover_policy, handle_cache=handle_cache)
+        super().__init__(path)
+        self._data = self._log_manager.rebuild_index()
+        self._sequence = sum(segment.records for segment in self._log_manager.segments)
+
+    @property
+    def sequence(self) -> int:
+        """
+        Increases with each write, and carries over when the engine is reopened. Compaction drops overwritten records,
+        so an engine reopened after a compaction counts only the surviving records: sequence numbers from before that
+        compaction are not comparable with those of the reopened engine.
+        """
+        return self._sequence
+
+    def get(self, key: str) -> str:
+        # Look up the index and read the segment under the lock, so that compaction can neither swap the segments
+        # between the two nor delete the segment before it is read
+        with self._log_manager.lock:
+            for i in range(len(self.data) - 1, -1, -1):
+                if key in self.data[i]:
+                    offset = self.data[i][key]
+                    entry = self._log_manager.get_from_segment(i, offset)
+                    return entry[key]
+
+        raise ValueError(f"Key {key} not found")
+
+    def snapshot(self) -> BitcaskSnapshot:
+        """
+        Return a read-only view of the current state. Only the index of the active segment is still written to, so it
+        is the only one that needs copying; older per-segment indexes are shared with the engine.
+        Call release() (or use the snapshot as a context manager) to let compaction delete the segments it pins.
+        """
+        with self._log_manager.lock:
+            segments = self._log_manager.segments.copy()
+            index = self.data[:-1] + [self.data[-1].copy()] if self.data else []
+            return BitcaskSnapshot(str(self.path), self._log_manager, segments, index, self._sequence)
+
     def _update_index(self, key: str, offset: int):
         # If offset is 0, then a new segment has been created. Create new index
         if offset == 0:
@@ -33,12 +111,25 @@ class Bitcask(BaseStorageEngine):
         self.data[-1][key] = offset
 
     def set(self, key: str, value: str) -> None:
-        offset = self._log_manager.set(key, value)
-        self._update_index(key, offset)
+        # Under the lock, so that snapshots see the index and sequence number of the same writes
+        with self._log_manager.lock:
+            offset = self._log_manager.set(key, value)
+            self._update_index(key, offset)
+            self._sequence += 1
 
     def compact(self):
-        self._log_manager.compact()
-        self._data = self._log_manager.rebuild_index()
+        old_segments, compacted_segments, compacted_index = self._log_manager.prepare_compaction()
+        # Swap segments and index together, so that snapshots never pair the old index with the new segments
+        with self._log_manager.lock:
+            self._log_manager.commit_compaction(old_segments, compacted_segments)
+            if old_segments:
+                self._data = compacted_index + self._data[len(old_segments):]
+
+    def stats(self) -> Dict[str, float]:
+        return self._log_manager.stats()
+
+    def close(self):
+        self._log_manager.close()
 
 def main():
     bitcask = Bitcask(PATH, 20)
@@ -0,0 +1,183 @@
+import os
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from base.storage_engine import BaseStorageEngineWithIO
+from log_structured.baseline_inmemory import DummyIOManager
+
+"""
+Purely in-memory storage engine that keeps entries sorted by key, like the memtable of an LSM-tree.
+Lookups are O(log N), and entries can be iterated in key order.
+"""
+
+# Blocks are split in two when they grow past twice this number of entries
+BLOCK_SIZE = 512
+SNAPSHOT_FILE = "snapshot.txt"
+
+
+class SortedBlockList:
+    """
+    Sorted map from keys to values, array-backed: entries are kept in blocks of parallel sorted key and value lists, plus
+    the last key of each block. Lookups are two binary searches, inserts only shift the pointers of one block, and the
+    overhead of each entry is one pointer for its key and one for its value.
+    """
+    __slots__ = ("_keys", "_values", "_maxes", "_length")
+
+    def __init__(self):
+        self._keys: List[List[str]] = []
+        self._values: List[List[str]] = []
+        # Last (largest) key of each block
+        self._maxes: List[str] = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _locate(self, key: str) -> Tuple[int, int]:
+        """
+        Returns the block and position of the first entry with a key greater than or equal to the given key. Keys past
+        the end are located at the end of the last block.
+        """
+        block = bisect_left(self._maxes, key)
+        if block == len(self._maxes):
+            if block == 0:
+                return 0, 0
+            block -= 1
+            return block, len(self._keys[block])
+        return block, bisect_left(self._keys[block], key)
+
+    def get(self, key: str) -> Optional[str]:
+        block, pos = self._locate(key)
+        if block < len(self._keys) and pos < len(self._keys[block]) and self._keys[block][pos] == key:
+            return self._values[block][pos]
+        return None
+
+    def __contains__(self, key: str) -> bool:
+        block, pos = self._locate(key)
+        return block < len(self._keys) and pos < len(self._keys[block]) and self._keys[block][pos] == key
+
+    def set(self, key: str, value: str) -> None:
+        if not self._keys:
+            self._keys.append([key])
+            self._values.append([value])
+            self._maxes.append(key)
+            self._length = 1
+            return
+
+        block, pos = self._locate(key)
+        keys = self._keys[block]
+        if pos < len(keys) and keys[pos] == key:
+            self._values[block][pos] = value
+            return
+
+        keys.insert(pos, key)
+        self._values[block].insert(pos, value)
+        self._maxes[block] = keys[-1]
+        self._length += 1
+        if len(keys) > 2 * BLOCK_SIZE:
+            self._split(block)
+
+    def _split(self, block: int):
+        keys, values = self._keys[block], self._values[block]
+        half = len(keys) // 2
+        self._keys.insert(block + 1, keys[half:])
+        self._values.insert(block + 1, values[half:])
+        del keys[half:]
+        del values[half:]
+        self._maxes[block] = keys[-1]
+        self._maxes.insert(block + 1, self._keys[block + 1][-1])
+
+    def items(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over (key, value) pairs in key order, from start (inclusive) to end (exclusive).
+        """
+        block, pos = (0, 0) if start is None else self._locate(start)
+        while block < len(self._keys):
+            keys, values = self._keys[block], self._values[block]
+            while pos < len(keys):
+                if end is not None and keys[pos] >= end:
+                    return
+                yield keys[pos], values[pos]
+                pos += 1
+            block += 1
+            pos = 0
+
+
+class SortedInMemoryStorageEngine(BaseStorageEngineWithIO):
+    """
+    In-memory storage engine with a sorted index. Replaces the O(N) baseline in-memory engine.
+    If a path is given, the contents can be snapshotted to disk and are loaded back when the engine is created.
+    """
+    _data: SortedBlockList
+
+    def __init__(self, path: str = ""):
+        self._data = SortedBlockList()
+        self.io_manager = DummyIOManager(path)
+        super().__init__(path)
+        # Path("") is the current directory: only snapshot to disk if a path was actually given
+        self._persistent = bool(path)
+        if self._persistent and self.snapshot_path.exists():
+            self.load_snapshot()
+
+    @property
+    def snapshot_path(self) -> Path:
+        return self.path / SNAPSHOT_FILE
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores key-value pair in memory. O(log N), plus shifting the entries of one block
+        """
+        self._data.set(key, value)
+
+    def get(self, key: str) -> str:
+        """
+        Retrieves value from given key. O(log N).
+        """
+        value = self._data.get(key)
+        if value is None:
+            raise ValueError(f"Key {key} not found in DB")
+        return value
+
+    def items(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        return self._data.items(start, end)
+
+    def save_snapshot(self):
+        """
+        Write all entries in key order as "key,value" lines. The snapshot is written to a temporary file and then
+        renamed, so a crash never leaves a partial snapshot behind.
+        """
+        if not self._persistent:
+            raise ValueError("Snapshots require the engine to be created with a path")
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as file:
+            for key, value in self._data.items():
+                file.write(f"{key},{value}\n".encode("utf-8"))
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        data = SortedBlockList()
+        with open(self.snapshot_path, "rb") as file:
+            for line in file:
+                key, value = line.decode("utf-8").strip().split(",")
+                data.set(key, value)
+        self._data = data
+
+    @property
+    def data(self):
+        return self._data
+
+
+def main():
+    storage = SortedInMemoryStorageEngine()
+    storage.set("42", "{example example}")
+    storage.set("10", "{another example}")
+    print(storage.get("42"))
+    print(storage.get("10"))
+    storage.set("42", "{updated}")
+    print(storage.get("42"))
+    print(list(storage.items()))
+
+
+if __name__ == "__main__":
+    main()
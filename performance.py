@@ -1,7 +1,14 @@
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
+import argparse
+import cProfile
+import sys
+import threading
 import time
 import shutil
-from typing import Dict, Any
+import tracemalloc
+from typing import Dict, Any, Optional
 
 from pympler import asizeof
 
@@ -10,6 +17,7 @@ from log_structured.baseline import BaselineLogStructuredStorageEngine
 from log_structured.baseline_inmemory import BaselineInMemoryLogStructuredStorageEngine
 from log_structured.indexed import IndexedLogStructuredStorageEngine
 from log_structured.bitcask import Bitcask
+from log_structured.sorted_inmemory import SortedInMemoryStorageEngine
 
 """
 Performance testing on each storage engine implemented.
@@ -20,6 +28,7 @@ Note that OOM errors are not tested, only basic memory usage at the end of the t
 STORAGE_ENGINE_CLASSES = [
     (BaselineLogStructuredStorageEngine, {}),
     (BaselineInMemoryLogStructuredStorageEngine, {}),
+    (SortedInMemoryStorageEngine, {}),
     (IndexedLogStructuredStorageEngine, {}),
     (Bitcask, {"max_segment_size": 1024 * 1024}),
 ]
@@ -27,6 +36,18 @@ STORAGE_ENGINE_CLASSES = [
 # Clean the test log file
 TEST_LOG_PATH = "log.txt"
 PARENT_DIRECTORY = "perftests"
+# Max depth of references followed when measuring memory usage
+MEMORY_DEPTH_LIMIT = 100_000
+# Profiling output (--profile)
+PROFILE_DIRECTORY = "profiles"
+SAMPLING_INTERVAL = 0.001
+# Each engine is run once under cProfile and the stack sampler, and once under tracemalloc
+PROFILE_CPU = "cpu"
+PROFILE_MEMORY = "memory"
+# Number of allocation sites written to the tracemalloc report of each phase, and frames kept per allocation. Reports
+# group allocations by their innermost line, and each extra frame slows down tracing
+TOP_ALLOCATIONS = 20
+TRACEMALLOC_FRAMES = 1
 
 
 def measure_time(func):
@@ -42,6 +63,110 @@ def measure_time(func):
     return wrapper
 
 
+class StackSampler:
+    """
+    Sampling profiler: periodically records the call stack of the profiled thread, in the collapsed format
+    ("outer;inner;innermost count" per line) that flame graph tools take as input.
+    """
+    def __init__(self, interval: float = SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: Path):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def cpu_profiled(prefix: str):
+    """
+    Run the body under cProfile and the stack sampler, then write:
+    - <prefix>.pstats: cProfile stats, to be loaded with pstats or snakeviz
+    - <prefix>.collapsed: sampled stacks, to be fed to flamegraph.pl or speedscope
+    """
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(f"{prefix}.pstats")
+        sampler.write(Path(f"{prefix}.collapsed"))
+
+
+@contextmanager
+def memory_profiled(prefix: str):
+    """
+    Run the body under tracemalloc, then write:
+    - <prefix>.tracemalloc: allocation snapshot, to be loaded with tracemalloc.Snapshot.load
+    - <prefix>.tracemalloc.txt: peak traced memory and top allocation sites still alive at the end of the phase
+    """
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Leave out the allocations of tracemalloc itself and of the profiling code in here
+        profiling_lines = {
+            line for _, _, line in memory_profiled.__wrapped__.__code__.co_lines() if line is not None
+        }
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)] +
+            [tracemalloc.Filter(False, __file__, line) for line in profiling_lines]
+        )
+
+        snapshot.dump(f"{prefix}.tracemalloc")
+        with open(f"{prefix}.tracemalloc.txt", "w") as file:
+            file.write(f"Peak traced memory: {peak / 1024:.2f} KB\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                file.write(f"{stat}\n")
+
+
+@contextmanager
+def profiled(engine_name: str, phase: str, profile_dir: Optional[Path], profile_mode: Optional[str]):
+    """
+    Profile the body for this engine and phase, writing to profile_dir/<engine>_<phase>.*. tracemalloc slows down the
+    code a lot and unevenly, so CPU and memory profiles come from separate runs (see profile_mode).
+    Does nothing if profile_dir is None.
+    """
+    if profile_dir is None:
+        yield
+        return
+
+    prefix = str(profile_dir / f"{engine_name}_{phase}")
+    profiler = cpu_profiled if profile_mode == PROFILE_CPU else memory_profiled
+    with profiler(prefix):
+        yield
+
+
 def teardown_dir(dir_path: Path):
     if dir_path.exists() and dir_path.is_dir():
         # Delete the directory and all its contents
@@ -91,22 +216,55 @@ def worst_case_read_performance(engine, non_existing_key: str):
         print(f"threw exception for nonexistent key")
 
 
+@measure_time
+def compact_performance(engine):
+    """
+    Test the performance of compacting the log, for engines that support it.
+    """
+    engine.compact()
+
+
+@measure_time
+def recovery_performance(engine_class, init_params: Dict[str, Any]):
+    """
+    Test the performance of reopening an engine on existing files.
+    """
+    return engine_class(**init_params)
+
+
 def object_size_in_kb(obj):
     """
     Returns the size of the given object in KB
     """
-    size = asizeof.asizeof(obj)
+    # asizeof recurses into referents, so linked structures (e.g. linked lists) are as deep as they are long. Raise the
+    # depth and recursion limits, otherwise they are silently undercounted.
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 10 * MEMORY_DEPTH_LIMIT))
+    try:
+        size = asizeof.asizeof(obj, limit=MEMORY_DEPTH_LIMIT)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
     return size / 1024
 
 
-def run_tests_on_engine(engine_class: BaseStorageEngine, init_params: Dict[str, Any], num_entries: int):
-    print(f"\nTesting storage engine: {engine_class.__name__} with parameters {init_params}")
+def run_tests_on_engine(engine_class: BaseStorageEngine, init_params: Dict[str, Any], num_entries: int,
+                        profile_dir: Optional[Path] = None, profile_mode: Optional[str] = None):
+    engine_name = engine_class.__name__
+    print(f"\nTesting storage engine: {engine_name} with parameters {init_params}")
+    if profile_dir is not None:
+        print(f"Profiling: {profile_mode}")
     engine = engine_class(**init_params)
 
     # Run the performance tests
-    write_performance(engine, num_entries)
-    read_performance(engine, num_entries)
-    worst_case_read_performance(engine, "non_existing_key")
+    with profiled(engine_name, "write", profile_dir, profile_mode):
+        write_performance(engine, num_entries)
+    with profiled(engine_name, "read", profile_dir, profile_mode):
+        read_performance(engine, num_entries)
+    with profiled(engine_name, "miss", profile_dir, profile_mode):
+        worst_case_read_performance(engine, "non_existing_key")
+    if hasattr(engine, "compact"):
+        with profiled(engine_name, "compact", profile_dir, profile_mode):
+            compact_performance(engine)
 
     # Memory usage at end of test. The tests I'll run on these toy engines are small in the interest of time, so these
     # numbers should be evaluated within the context of performance comparison.
@@ -114,28 +272,59 @@ def run_tests_on_engine(engine_class: BaseStorageEngine, init_params: Dict[str,
     memory_size = object_size_in_kb(engine.data)
     print(f"Memory usage: {memory_size:.2f} KB")
 
+    # Segment stats, for engines that split their log into segments
+    if hasattr(engine, "stats"):
+        stats = engine.stats()
+        print(f"Segments: {stats['segment_count']}, rollovers: {stats['rollovers']}, "
+              f"rollover latency avg/max: {stats['rollover_latency_avg']:.6f}/{stats['rollover_latency_max']:.6f} seconds")
+        print(f"Segment handle cache hits: {stats['hits']}, misses: {stats['misses']}, "
+              f"evictions: {stats['evictions']}")
+
+    engine.close()
+    with profiled(engine_name, "recovery", profile_dir, profile_mode):
+        engine = recovery_performance(engine_class, init_params)
+    engine.close()
+
     cleanup()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Performance testing on each storage engine implemented.")
+    parser.add_argument("--num-entries", type=int, default=10_000)
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile each engine and phase. Timings include the profiling overhead.")
+    parser.add_argument("--profile-dir", default=PROFILE_DIRECTORY)
+    args = parser.parse_args()
+
     # Configure test parameters
-    num_entries = 10_000
+    num_entries = args.num_entries
+    profile_dir = None
+    if args.profile:
+        profile_dir = Path(args.profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        print(f"Writing profiles to {profile_dir}")
 
     teardown_dir(Path(PARENT_DIRECTORY))
 
     # Set up test directory
     Path(PARENT_DIRECTORY).mkdir(parents=True, exist_ok=True)
-    db_path = Path(PARENT_DIRECTORY) / TEST_LOG_PATH
+    # Engines take the directory their log files are written to
+    db_path = Path(PARENT_DIRECTORY)
 
     print(f"Found {len(STORAGE_ENGINE_CLASSES)} storage engines to test:")
     for engine_class, params in STORAGE_ENGINE_CLASSES:
         print(f" - {engine_class.__name__} with parameters {params}")
 
     # Run tests
+    profile_modes = [PROFILE_CPU, PROFILE_MEMORY] if profile_dir is not None else [None]
     for engine_class, params in STORAGE_ENGINE_CLASSES:
         # Inject test path
         params["path"] = db_path
-        run_tests_on_engine(engine_class, params, num_entries)
+        for profile_mode in profile_modes:
+            # Each run starts from an empty directory
+            teardown_dir(db_path)
+            db_path.mkdir(parents=True)
+            run_tests_on_engine(engine_class, params, num_entries, profile_dir, profile_mode)
 
     teardown_dir(Path(PARENT_DIRECTORY))
 
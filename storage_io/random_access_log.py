@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict
+from typing import BinaryIO, Dict
 
 from base.base_io import BaseIOManager
 
@@ -12,8 +12,15 @@ class RandomAccessLogManager(BaseIOManager):
         super().__init__(f"{path}/log.txt")
 
     def read(self, offset: int) -> Dict[str, str]:
-        self.file.seek(offset)
-        line = self.file.readline()
+        return self.read_from(self.file, offset)
+
+    @staticmethod
+    def read_from(file: BinaryIO, offset: int) -> Dict[str, str]:
+        """
+        Read the entry at the given offset of any handle to a log file, leaving the file pointer after the entry.
+        """
+        file.seek(offset)
+        line = file.readline()
         if not line:
             raise EOFError()
         line = line.decode("utf-8")
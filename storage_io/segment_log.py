@@ -1,7 +1,9 @@
 import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 from storage_io.random_access_log import RandomAccessLogManager
 from base.base_io import BaseIOManager
@@ -17,76 +19,411 @@ class LogSegment(RandomAccessLogManager):
         :param path:
         """
         BaseIOManager.__init__(self, path)
+        # Number of entries and bytes appended to the segment, and when it became the active segment (monotonic clock).
+        # Reads move the file pointer, so tell() is not the size of the segment
+        self.records = 0
+        self.size = 0
+        self.created_at = time.monotonic()
+
+    def append(self, entry: str) -> int:
+        offset = super().append(entry)
+        self.records += 1
+        # Right after the write, the file pointer is at the end of the file
+        self.size = self.file.tell()
+        return offset
 
     def tell(self):
         return self.file.tell()
 
 
+class RolloverPolicy:
+    """
+    Decides when the active segment is full. A segment is rolled over as soon as any of the configured triggers fires:
+    size in bytes, number of records, or age in seconds. Triggers set to None are disabled.
+    """
+    def __init__(self, max_size: Optional[int] = 1024 * 1024, max_records: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        self.max_size = max_size
+        self.max_records = max_records
+        self.max_age = max_age
+
+    def is_full(self, segment: LogSegment) -> bool:
+        """
+        Size and record-count triggers only. Compacted segments are split with these: their age only reflects how long
+        compaction has been running.
+        """
+        if self.max_size is not None and segment.size >= self.max_size:
+            return True
+        if self.max_records is not None and segment.records >= self.max_records:
+            return True
+        return False
+
+    def should_rollover(self, segment: LogSegment) -> bool:
+        if self.is_full(segment):
+            return True
+        if self.max_age is not None and time.monotonic() - segment.created_at >= self.max_age:
+            return True
+        return False
+
+
+class SegmentHandleCache:
+    """
+    Bounded LRU cache of read-only handles to segment files, so that reads don't pay an open() per lookup and the number
+    of open files stays bounded. It can be shared by several segment managers.
+    Handles are pinned while in use: eviction skips them, and closing an invalidated handle is deferred until it is
+    released.
+    """
+    _handles: "OrderedDict[Path, BinaryIO]"
+    _pins: Dict[int, int]
+
+    def __init__(self, max_handles: int = 128):
+        if max_handles < 1:
+            raise ValueError(f"max_handles must be at least 1, got {max_handles}")
+        self.max_handles = max_handles
+        # Least recently used handle first
+        self._handles = OrderedDict()
+        # Number of readers currently using each handle, by id of the handle
+        self._pins = {}
+        self.lock = threading.Lock()
+        # Cache stats
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @contextmanager
+    def handle(self, path: Path) -> Iterator[BinaryIO]:
+        """
+        Pin and return a handle to the given file, opening it if it isn't cached.
+        """
+        file = self._acquire(path)
+        try:
+            yield file
+        finally:
+            self._release(path, file)
+
+    def _acquire(self, path: Path) -> BinaryIO:
+        with self.lock:
+            file = self._handles.get(path)
+            if file is None:
+                self._misses += 1
+                file = open(path, "rb")
+                self._handles[path] = file
+            else:
+                self._hits += 1
+                self._handles.move_to_end(path)
+            self._pins[id(file)] = self._pins.get(id(file), 0) + 1
+            self._evict()
+        return file
+
+    def _release(self, path: Path, file: BinaryIO):
+        with self.lock:
+            count = self._pins[id(file)] - 1
+            if count > 0:
+                self._pins[id(file)] = count
+                return
+            del self._pins[id(file)]
+            if self._handles.get(path) is not file:
+                # Invalidated while in use
+                file.close()
+            # Evictions may have been skipped while this handle was pinned
+            self._evict()
+
+    def _evict(self):
+        """
+        Close least recently used handles until the cache fits, skipping pinned ones. Must hold the lock.
+        """
+        if len(self._handles) <= self.max_handles:
+            return
+        for path in list(self._handles):
+            if len(self._handles) <= self.max_handles:
+                break
+            if id(self._handles[path]) in self._pins:
+                continue
+            self._handles.pop(path).close()
+            self._evictions += 1
+
+    def invalidate(self, path: Path):
+        """
+        Drop the handle to a file that is about to be deleted or replaced.
+        """
+        with self.lock:
+            file = self._handles.pop(path, None)
+            if file is not None and id(file) not in self._pins:
+                file.close()
+
+    def clear(self):
+        with self.lock:
+            for path in list(self._handles):
+                file = self._handles.pop(path)
+                if id(file) not in self._pins:
+                    file.close()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "open_handles": len(self._handles),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
+
+
+# Max size of the segments in bytes, when neither a size nor a rollover policy is given
+DEFAULT_MAX_SEGMENT_SIZE = 1024 * 1024
+# Suffix of a segment file that has been preallocated but is not in use yet
+PREALLOCATED_SUFFIX = ".next"
+
+
+def segment_file_name(sequence: int, generation: int = 0) -> str:
+    """
+    Segments are named after a sequence number, increasing with each rollover, and a generation, increasing with each
+    compacted segment written (0 for segments written by rollover). Compacted segments reuse the sequence number of
+    the last segment they replace (or the one right below the active segment, when replacing legacy segments), so that
+    they sort after the data they replace but before any newer segment.
+    """
+    return f"{sequence:010d}_{generation:010d}.log"
+
+
+def is_legacy_segment(path: Path) -> bool:
+    """
+    Segments written before sequence numbers were introduced are named after their creation timestamp.
+    """
+    return "_" not in path.name
+
+
+def segment_sort_key(path: Path) -> Tuple[int, float, int]:
+    """
+    Order of the segments from oldest to most recent data. Legacy segments come first, ordered by timestamp.
+    """
+    if is_legacy_segment(path):
+        return 0, float(path.stem), 0
+    sequence, generation = path.name.split(".")[0].split("_")
+    return 1, int(sequence), int(generation)
+
+
 class LogSegmentManager:
     """
     Class to manage multiple log segments, including compacting utilities.
     """
     _segments: List[LogSegment]
-    _max_segment_size: int
+    _rollover_policy: RolloverPolicy
+    _refcounts: Dict[Path, int]
+    _pending_deletion: Dict[Path, LogSegment]
 
-    def __init__(self, path: str, max_segment_size: int = 1024 * 1024):
+    def __init__(self, path: str, max_segment_size: Optional[int] = None,
+                 rollover_policy: Optional[RolloverPolicy] = None, handle_cache: Optional[SegmentHandleCache] = None):
+        """
+        :param max_segment_size: shorthand for a size-only rollover policy. Can't be combined with rollover_policy.
+        """
+        if max_segment_size is not None and rollover_policy is not None:
+            raise ValueError("Pass either max_segment_size or rollover_policy, not both")
         self.path = Path(path)
-        # Max size of the segments in bytes
-        self._max_segment_size = max_segment_size
+        # Handles used to read segments that are not open for writing
+        self._handle_cache = handle_cache if handle_cache is not None else SegmentHandleCache()
+        if rollover_policy is None:
+            if max_segment_size is None:
+                max_segment_size = DEFAULT_MAX_SEGMENT_SIZE
+            rollover_policy = RolloverPolicy(max_size=max_segment_size)
+        self._rollover_policy = rollover_policy
         self._segments = []
-        self.lock = threading.Lock()   # To synchronize segment updates
+        # Number of snapshots referencing each segment file, and segments compacted away while still referenced
+        self._refcounts = {}
+        self._pending_deletion = {}
+        self.lock = threading.RLock()   # To synchronize segment updates (re-entrant so snapshots can pin under it)
+        # Next segment, opened in the background so that rollover doesn't create a file on the write path
+        self._next_segment: Optional[LogSegment] = None
+        self._preallocator: Optional[threading.Thread] = None
+        # Rollover stats
+        self._rollovers = 0
+        self._rollover_latency_total = 0.0
+        self._rollover_latency_max = 0.0
+        # Next sequence number and compaction generation to use in segment names, set by recover_segments
+        # Sequence numbers start at 1, leaving 0 for compacting legacy segments
+        self._next_sequence = 1
+        self._next_generation = 1
         # If there are previous segments in the path, recover them
         self.recover_segments()
 
     @property
     def max_segment_size(self):
         """ Enforce read-only """
-        return self._max_segment_size
+        return self._rollover_policy.max_size
+
+    @property
+    def rollover_policy(self) -> RolloverPolicy:
+        return self._rollover_policy
 
     @property
     def segments(self):
         return self._segments
 
     def get_from_segment(self, segment_id: int, offset: int) -> Dict[str, str]:
-        segment = self.segments[segment_id]
+        return self.read_segment(self.segments[segment_id], offset)
 
+    def read_segment(self, segment: LogSegment, offset: int) -> Dict[str, str]:
+        """
+        Read the entry at the given offset of a segment, which may no longer be part of the active segment list
+        (e.g. a segment pinned by a snapshot after compaction).
+        """
         with self.lock:
-            if segment.file is None:
-                # Open, then close if segment was closed
-                segment.open()
-                entry = segment.read(offset)
-                segment.close()
-            else:
-                # Keep open if already open
-                entry = segment.read(offset)
-        return entry
+            if segment.is_open():
+                # Read through the segment's own handle, which also sees its unflushed writes
+                return segment.read(offset)
+            with self._handle_cache.handle(segment.path) as file:
+                return LogSegment.read_from(file, offset)
+
+    def _scan_segment(self, segment: LogSegment) -> Iterator[Tuple[int, int, Dict[str, str]]]:
+        """
+        Iterate over the (offset, offset of the next entry, entry) tuples of a segment.
+        """
+        offset = 0
+        while True:
+            with self.lock:
+                try:
+                    if segment.is_open():
+                        entry = segment.read(offset)
+                        next_offset = segment.tell()
+                    else:
+                        with self._handle_cache.handle(segment.path) as file:
+                            entry = LogSegment.read_from(file, offset)
+                            next_offset = file.tell()
+                except EOFError:
+                    return
+            yield offset, next_offset, entry
+            offset = next_offset
+
+    def _delete_segment(self, segment: LogSegment):
+        segment.close()
+        self._handle_cache.invalidate(segment.path)
+        segment.path.unlink()
+
+    def acquire(self, segments: List[LogSegment]):
+        """
+        Pin segments so that compaction does not delete their files while they are still referenced.
+        """
+        with self.lock:
+            for segment in segments:
+                self._refcounts[segment.path] = self._refcounts.get(segment.path, 0) + 1
+
+    def release(self, segments: List[LogSegment]):
+        """
+        Unpin segments. Files that were compacted away while pinned are deleted once their last reference is gone.
+        """
+        to_delete: List[LogSegment] = []
+        with self.lock:
+            for segment in segments:
+                count = self._refcounts[segment.path] - 1
+                if count > 0:
+                    self._refcounts[segment.path] = count
+                    continue
+                del self._refcounts[segment.path]
+                if segment.path in self._pending_deletion:
+                    to_delete.append(self._pending_deletion.pop(segment.path))
+
+        for segment in to_delete:
+            self._delete_segment(segment)
 
     def get_segment_name(self) -> Path:
         """
-        To avoid
+        Name of the next segment written by rollover. Recovery order depends on segment names, so they must not
+        depend on the wall clock.
+        """
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        return self.path / segment_file_name(sequence)
+
+    def get_compacted_segment_name(self, sequence: int) -> Path:
+        """
+        Name of the next compacted segment replacing segments up to the given sequence number.
+        """
+        generation = self._next_generation
+        self._next_generation += 1
+        return self.path / segment_file_name(sequence, generation)
+
+    def _preallocate_segment(self):
+        """
+        Create and open the next segment file. Runs in a background thread. The file gets a suffix that
+        recover_segments ignores, so an unused preallocated segment is never mistaken for an empty log segment.
         """
-        timestamp = time.time()
-        return self.path / f"{timestamp}.log"
+        segment = LogSegment(str(self.get_segment_name()) + PREALLOCATED_SUFFIX)
+        segment.open()
+        self._next_segment = segment
+
+    def _start_preallocation(self):
+        self._preallocator = threading.Thread(target=self._preallocate_segment, daemon=True)
+        self._preallocator.start()
+
+    def _take_preallocated_segment(self) -> LogSegment:
+        if self._preallocator is None:
+            # Nothing in flight (first rollover): create the segment synchronously
+            self._preallocate_segment()
+        else:
+            # Normally finished long ago, since the previous rollover
+            self._preallocator.join()
+            self._preallocator = None
+        segment = self._next_segment
+        self._next_segment = None
+        # Rename only affects the directory entry, the open handle stays valid
+        segment.path = segment.path.rename(segment.path.with_suffix(""))
+        segment.created_at = time.monotonic()
+        return segment
 
     def _rollover_segment(self, curr_segment):
         """
         Roll over to new segment.
         """
+        start_time = time.perf_counter()
         with self.lock:
             # Close current segment if it exists
             if curr_segment and curr_segment.is_open():
                 curr_segment.close()
-            # Instantiate new segment -- ID can be the current length of the segment list
-        curr_segment = LogSegment(str(self.get_segment_name()))
+        # ID can be the current length of the segment list
+        curr_segment = self._take_preallocated_segment()
         with self.lock:
-            curr_segment.open()
             self.segments.append(curr_segment)
+        self._start_preallocation()
+
+        elapsed_time = time.perf_counter() - start_time
+        self._rollovers += 1
+        self._rollover_latency_total += elapsed_time
+        self._rollover_latency_max = max(self._rollover_latency_max, elapsed_time)
+
+    def close(self):
+        """
+        Close all segments and discard the preallocated segment, if any.
+        """
+        if self._preallocator is not None:
+            self._preallocator.join()
+            self._preallocator = None
+        if self._next_segment is not None:
+            self._next_segment.close()
+            self._next_segment.path.unlink()
+            self._next_segment = None
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+                self._handle_cache.invalidate(segment.path)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Segment count and rollover latency (in seconds) since the manager was created.
+        """
+        return {
+            "segment_count": len(self.segments),
+            "rollovers": self._rollovers,
+            "rollover_latency_total": self._rollover_latency_total,
+            "rollover_latency_max": self._rollover_latency_max,
+            "rollover_latency_avg": self._rollover_latency_total / self._rollovers if self._rollovers else 0.0,
+            **self._handle_cache.stats(),
+        }
 
     def set(self, key: str, value: str) -> int:
         curr_segment = self.segments[-1] if self.segments else None
         if curr_segment and not curr_segment.is_open():
             curr_segment.open()
-        if not curr_segment or curr_segment.tell() >= self.max_segment_size:
+        if not curr_segment or self._rollover_policy.should_rollover(curr_segment):
             # Current segment is full, generate new one
             self._rollover_segment(curr_segment)
         curr_segment = self.segments[-1]
@@ -104,20 +441,14 @@ class LogSegmentManager:
 
         for curr_segment in self.segments:
             curr_dict = {}
-            offset = 0
-
-            if not curr_segment.is_open():
-                curr_segment.open()
+            curr_segment.records = 0
+            curr_segment.size = 0
 
-            while True:
-                try:
-                    entry = curr_segment.read(offset)
-                    for key in entry.keys():
-                        curr_dict[key] = offset
-                    offset = curr_segment.tell()
-                except EOFError:
-                    break
-            curr_segment.close()
+            for offset, next_offset, entry in self._scan_segment(curr_segment):
+                for key in entry.keys():
+                    curr_dict[key] = offset
+                curr_segment.records += 1
+                curr_segment.size = next_offset
             index.append(curr_dict)
 
         return index
@@ -127,54 +458,90 @@ class LogSegmentManager:
         Searching for segments would normally be handled with file metadata. To keep things simple here, we use the
         simple requirement that all segments (and only the segments) in the directory end with .log
         """
-        log_files = list(self.path.glob("*.log"))
+        # Sort segments so that the most recent one is last
+        log_files = sorted(self.path.glob("*.log"), key=segment_sort_key)
+
+        # Preallocated segments left over by a previous run were never written to
+        for file in self.path.glob(f"*.log{PREALLOCATED_SUFFIX}"):
+            file.unlink()
 
         for file in log_files:
             segment = LogSegment(str(file))
             self._segments.append(segment)
+            if is_legacy_segment(file):
+                continue
+            _, sequence, generation = segment_sort_key(file)
+            self._next_sequence = max(self._next_sequence, sequence + 1)
+            self._next_generation = max(self._next_generation, generation + 1)
 
-    def compact(self):
+    def prepare_compaction(self) -> Tuple[List[LogSegment], List[LogSegment], List[Dict[str, int]]]:
+        """
+        Write the latest entries of all segments except for the active one into new compacted segments, without
+        swapping them in. Returns the segments to replace, the compacted segments and their index.
+        """
         # Compact everything except for the active segment (last segment)
-        segments = self.segments[:-1]
+        with self.lock:
+            segments = self.segments[:-1]
+            active_segment = self.segments[-1] if self.segments else None
+        if not segments or is_legacy_segment(active_segment.path):
+            # No name sorts between two legacy segments: wait until the active segment has rolled over
+            return [], [], []
+        # Compacted segments must sort before the active segment, which holds more recent data
+        if is_legacy_segment(segments[-1].path):
+            # The active segment is the first with a sequence number, which is at least 1
+            sequence = segment_sort_key(active_segment.path)[1] - 1
+        else:
+            sequence = segment_sort_key(segments[-1].path)[1]
 
         # Collect all unique entries starting from most recent segment
         latest_entries = {}
         for curr_segment in segments:
-            if not curr_segment.is_open():
-                curr_segment.open()
-
-            offset = 0
-            while True:
-                try:
-                    entry = curr_segment.read(offset)
-                    for key, value in entry.items():
-                        latest_entries[key] = value
-                    offset = curr_segment.tell()
-                except EOFError:
-                    break
-            curr_segment.close()
+            for _, _, entry in self._scan_segment(curr_segment):
+                for key, value in entry.items():
+                    latest_entries[key] = value
 
         def create_compacted_segment():
-            segment = LogSegment(str(self.get_segment_name()))
+            segment = LogSegment(str(self.get_compacted_segment_name(sequence)))
             segment.open()
             return segment
 
         compacted_segments: List[LogSegment] = [create_compacted_segment()]
+        compacted_index: List[Dict[str, int]] = [{}]
 
         curr_segment: LogSegment = compacted_segments[0]
         for key, value in latest_entries.items():
-            if curr_segment.tell() >= self.max_segment_size:
+            if self._rollover_policy.is_full(curr_segment):
                 # Rollover to new segment
                 curr_segment.close()
                 curr_segment = create_compacted_segment()
                 compacted_segments.append(curr_segment)
-            curr_segment.append(f"{key},{value}")
+                compacted_index.append({})
+            compacted_index[-1][key] = curr_segment.append(f"{key},{value}")
 
-        # Replace atomically with compacted segments
+        return segments, compacted_segments, compacted_index
+
+    def commit_compaction(self, old_segments: List[LogSegment], compacted_segments: List[LogSegment]):
+        """
+        Replace the segments returned by prepare_compaction with the compacted segments. Callers that keep an index
+        of the segments must swap it while holding the lock, together with this call.
+        """
+        if not old_segments:
+            return
+
+        # Delete old files, unless a snapshot still references them: release() will delete those
+        to_delete: List[LogSegment] = []
         with self.lock:
-            old_segments = self.segments[:-1].copy()
-            self._segments = compacted_segments + self.segments[-1:]
+            # Segments rolled over during compaction are kept
+            self._segments = compacted_segments + self.segments[len(old_segments):]
+            for segment in old_segments:
+                if self._refcounts.get(segment.path, 0) > 0:
+                    self._pending_deletion[segment.path] = segment
+                else:
+                    to_delete.append(segment)
+
+        for segment in to_delete:
+            self._delete_segment(segment)
 
-        # Delete old files
-        for segment in old_segments:
-            segment.path.unlink()
+    def compact(self):
+        old_segments, compacted_segments, _ = self.prepare_compaction()
+        self.commit_compaction(old_segments, compacted_segments)
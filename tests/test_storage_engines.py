@@ -1,4 +1,6 @@
+import random
 import shutil
+import threading
 
 import pytest
 from pathlib import Path
@@ -6,6 +8,8 @@ from log_structured.baseline import BaselineLogStructuredStorageEngine
 from log_structured.baseline_inmemory import BaselineInMemoryLogStructuredStorageEngine
 from log_structured.indexed import IndexedLogStructuredStorageEngine
 from log_structured.bitcask import Bitcask
+from log_structured.sorted_inmemory import SortedInMemoryStorageEngine
+from storage_io.segment_log import RolloverPolicy, SegmentHandleCache
 
 
 TEST_DIR = "testfiles"
@@ -49,6 +53,8 @@ def storage_engine(request):
                      id="BaselineLogStructuredStorageEngine"),
         pytest.param(lambda: BaselineInMemoryLogStructuredStorageEngine(),
                      id="BaselineInMemoryLogStructuredStorageEngine"),
+        pytest.param(lambda: SortedInMemoryStorageEngine(),
+                     id="SortedInMemoryStorageEngine"),
         pytest.param(lambda: IndexedLogStructuredStorageEngine(TEST_DIR),
                      id="IndexedLogStructuredStorageEngine"),
         # Bitcask with one segment
@@ -73,3 +79,295 @@ def test_storage_engine(storage_engine):
     # Test update functionality
     storage_engine.set("42", "{updated}")
     assert storage_engine.get("42") == "{updated}"
+
+    storage_engine.close()
+
+
+def test_bitcask_snapshot_is_consistent():
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1)
+    bitcask.set("42", "before")
+    bitcask.set("10", "before")
+
+    with bitcask.snapshot() as snapshot:
+        assert snapshot.sequence == 2
+        bitcask.set("42", "after")
+        bitcask.set("7", "after")
+
+        assert bitcask.get("42") == "after"
+        assert snapshot.get("42") == "before"
+        assert snapshot.get("10") == "before"
+        with pytest.raises(ValueError):
+            snapshot.get("7")
+        with pytest.raises(RuntimeError):
+            snapshot.set("42", "nope")
+
+    bitcask.close()
+    # Sequence numbers carry over when the engine is reopened
+    recovered = Bitcask(TEST_DIR, max_segment_size=1)
+    assert recovered.sequence == 4
+    recovered.close()
+
+
+def test_bitcask_snapshot_survives_compaction():
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1)
+    bitcask.set("42", "v1")
+    bitcask.set("42", "v2")
+    bitcask.set("10", "v1")
+
+    snapshot = bitcask.snapshot()
+    pinned = [segment.path for segment in bitcask._log_manager.segments[:-1]]
+    bitcask.compact()
+
+    # Compacted segments are kept alive while the snapshot references them
+    assert all(path.exists() for path in pinned)
+    assert snapshot.get("42") == "v2"
+    assert bitcask.get("42") == "v2"
+
+    snapshot.release()
+    assert not any(path.exists() for path in pinned)
+    bitcask.close()
+
+
+def test_bitcask_rollover_policy_records():
+    bitcask = Bitcask(TEST_DIR, rollover_policy=RolloverPolicy(max_size=None, max_records=2))
+    for i in range(5):
+        bitcask.set(str(i), f"value_{i}")
+
+    for i in range(5):
+        assert bitcask.get(str(i)) == f"value_{i}"
+    stats = bitcask.stats()
+    assert stats["segment_count"] == 3
+    assert stats["rollovers"] == 3
+    assert stats["rollover_latency_max"] >= stats["rollover_latency_avg"] > 0
+
+    bitcask.close()
+    # The preallocated segment is discarded, only the written segments are left
+    assert len(list(Path(TEST_DIR).iterdir())) == 3
+
+
+def test_bitcask_rollover_policy_age():
+    bitcask = Bitcask(TEST_DIR, rollover_policy=RolloverPolicy(max_size=None, max_age=0))
+    bitcask.set("42", "v1")
+    bitcask.set("42", "v2")
+
+    assert bitcask.get("42") == "v2"
+    assert bitcask.stats()["segment_count"] == 2
+
+    # Compacted segments are not split by age
+    for i in range(10):
+        bitcask.set(str(i), f"value_{i}")
+    bitcask.compact()
+    assert bitcask.stats()["segment_count"] == 2
+    assert bitcask.get("42") == "v2"
+    assert bitcask.get("9") == "value_9"
+    bitcask.close()
+
+    # Recovery ignores leftovers and rebuilds the same state
+    recovered = Bitcask(TEST_DIR)
+    assert recovered.get("42") == "v2"
+    recovered.close()
+
+    with pytest.raises(ValueError):
+        Bitcask(TEST_DIR, max_segment_size=1, rollover_policy=RolloverPolicy(max_age=0))
+
+
+def test_bitcask_handle_cache_is_bounded():
+    cache = SegmentHandleCache(max_handles=2)
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1, handle_cache=cache)
+    for i in range(10):
+        bitcask.set(str(i), f"value_{i}")
+
+    for _ in range(2):
+        for i in range(10):
+            assert bitcask.get(str(i)) == f"value_{i}"
+    stats = cache.stats()
+    assert stats["open_handles"] <= 2
+    assert stats["evictions"] > 0
+
+    bitcask.compact()
+    for i in range(10):
+        assert bitcask.get(str(i)) == f"value_{i}"
+    bitcask.close()
+    assert len(cache) == 0
+
+
+def test_handle_cache_pins_handles_in_use():
+    paths = []
+    for i in range(3):
+        path = Path(TEST_DIR) / f"{i}.log"
+        path.write_bytes(f"{i},value_{i}\n".encode("utf-8"))
+        paths.append(path)
+    cache = SegmentHandleCache(max_handles=1)
+
+    with cache.handle(paths[0]) as pinned:
+        # Neither eviction nor invalidation closes a handle that is in use
+        with cache.handle(paths[1]):
+            pass
+        cache.invalidate(paths[0])
+        with cache.handle(paths[2]):
+            pass
+        assert not pinned.closed
+        assert pinned.readline() == b"0,value_0\n"
+    assert pinned.closed
+    assert len(cache) == 1
+
+
+def test_sorted_inmemory_ordered_iteration_and_snapshot():
+    storage = SortedInMemoryStorageEngine(TEST_DIR)
+    for key in ["b", "d", "a", "c", "b"]:
+        storage.set(key, f"value_{key}")
+
+    assert [key for key, _ in storage.items()] == ["a", "b", "c", "d"]
+    assert list(storage.items("b", "d")) == [("b", "value_b"), ("c", "value_c")]
+    with pytest.raises(ValueError):
+        storage.get("e")
+
+    storage.save_snapshot()
+    storage.set("e", "value_e")
+    # Only what was snapshotted is loaded back
+    recovered = SortedInMemoryStorageEngine(TEST_DIR)
+    assert list(recovered.items()) == [("a", "value_a"), ("b", "value_b"), ("c", "value_c"), ("d", "value_d")]
+
+    # Without a path, there is nowhere to snapshot to
+    with pytest.raises(ValueError):
+        SortedInMemoryStorageEngine().save_snapshot()
+
+
+def test_bitcask_recovers_latest_value_after_compaction():
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1)
+    bitcask.set("k", "v1")
+    bitcask.set("x", "v1")
+    bitcask.set("k", "v2")
+    bitcask.compact()
+    assert bitcask.get("k") == "v2"
+    bitcask.close()
+
+    recovered = Bitcask(TEST_DIR, max_segment_size=1)
+    assert recovered.get("k") == "v2"
+    assert recovered.get("x") == "v1"
+    # Segments written after recovery still sort after the compacted ones
+    recovered.set("k", "v3")
+    recovered.compact()
+    recovered.close()
+
+    recovered = Bitcask(TEST_DIR, max_segment_size=1)
+    assert recovered.get("k") == "v3"
+    recovered.close()
+
+
+def test_bitcask_snapshot_during_compaction_is_consistent():
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1)
+    bitcask.set("a", "v1")
+    bitcask.set("b", "v1")
+    bitcask.set("a", "v2")
+
+    log_manager = bitcask._log_manager
+    commit_compaction = log_manager.commit_compaction
+    snapshots = []
+    thread = threading.Thread(target=lambda: snapshots.append(bitcask.snapshot()))
+
+    def commit_then_snapshot(*args):
+        commit_compaction(*args)
+        # Segments are swapped but the index isn't yet: the snapshot must wait for both
+        thread.start()
+        thread.join(timeout=0.1)
+        assert not snapshots
+
+    log_manager.commit_compaction = commit_then_snapshot
+    bitcask.compact()
+    thread.join()
+
+    with snapshots[0] as snapshot:
+        assert snapshot.get("a") == "v2"
+        assert snapshot.get("b") == "v1"
+    bitcask.close()
+
+
+def test_bitcask_get_during_compaction():
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1)
+    bitcask.set("b", "v1")
+    bitcask.set("a", "v1")
+    bitcask.set("a", "v2")
+    bitcask.set("c", "v1")
+
+    log_manager = bitcask._log_manager
+    commit_compaction = log_manager.commit_compaction
+    values = []
+    thread = threading.Thread(target=lambda: values.append((bitcask.get("a"), bitcask.get("c"))))
+
+    def commit_then_get(*args):
+        commit_compaction(*args)
+        # Old segments are deleted but the index isn't swapped yet: the read must wait for both
+        thread.start()
+        thread.join(timeout=0.1)
+        assert not values
+
+    log_manager.commit_compaction = commit_then_get
+    bitcask.compact()
+    thread.join()
+
+    assert values == [("v2", "v1")]
+    bitcask.close()
+
+
+def test_bitcask_segment_size_ignores_reads():
+    bitcask = Bitcask(TEST_DIR, max_segment_size=50)
+    for i in range(20):
+        bitcask.set(f"key_{i}", f"value_{i}")
+        # Reads from the active segment move its file pointer back
+        assert bitcask.get("key_0") == "value_0"
+    bitcask.close()
+
+    entry_size = len("key_19,value_19\n")
+    segment_paths = list(Path(TEST_DIR).glob("*.log"))
+    assert all(path.stat().st_size < 50 + entry_size for path in segment_paths)
+
+    # Sizes are recomputed on recovery
+    recovered = Bitcask(TEST_DIR, max_segment_size=50)
+    assert [segment.size for segment in recovered._log_manager.segments] == \
+        [segment.path.stat().st_size for segment in recovered._log_manager.segments]
+    recovered.close()
+
+
+def test_bitcask_recovers_legacy_segment_names():
+    # Segments named after their creation timestamp, before sequence numbers were introduced
+    (Path(TEST_DIR) / "1729000000.123.log").write_bytes(b"k,v1\nx,v1\n")
+    (Path(TEST_DIR) / "1729000001.5.log").write_bytes(b"k,v2\n")
+
+    bitcask = Bitcask(TEST_DIR, max_segment_size=1)
+    assert bitcask.get("k") == "v2"
+    assert bitcask.get("x") == "v1"
+    # Nothing to compact until the active segment has rolled over to a new name
+    bitcask.compact()
+    assert len(list(Path(TEST_DIR).glob("*.log"))) == 2
+
+    bitcask.set("k", "v3")
+    bitcask.compact()
+    assert bitcask.get("k") == "v3"
+    assert bitcask.get("x") == "v1"
+    bitcask.close()
+
+    recovered = Bitcask(TEST_DIR, max_segment_size=1)
+    assert recovered.get("k") == "v3"
+    assert recovered.get("x") == "v1"
+    recovered.close()
+
+
+def test_sorted_inmemory_matches_dict():
+    storage = SortedInMemoryStorageEngine()
+    expected = {}
+    rng = random.Random(42)
+    # Enough entries to split blocks
+    for i in range(5000):
+        key = f"key_{rng.randrange(3000)}"
+        storage.set(key, f"value_{i}")
+        expected[key] = f"value_{i}"
+
+    assert len(storage.data) == len(expected)
+    assert list(storage.items()) == sorted(expected.items())
+    assert list(storage.items("key_1", "key_2")) == sorted(
+        (key, value) for key, value in expected.items() if "key_1" <= key < "key_2")
+    for key, value in expected.items():
+        assert storage.get(key) == value
+    with pytest.raises(ValueError):
+        storage.get("key_3000")